@@ -1,26 +1,155 @@
 #! /usr/bin/env python
 # coding:utf-8
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import math
+import os
 import numpy as np
 import cv2
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
 
-def ColorConstancy(img_file):
-    img = cv2.imread(img_file)
-    # gamma correction
-    gamma = 2.2
-    look_up_table = np.ones((256, 1), dtype = 'uint8' ) * 0
-    for i in range(256):
-        look_up_table[i][0] = 255 * pow(float(i) / 255, 1.0 / gamma)
-    img = cv2.LUT(img, look_up_table)
+# the illuminant is three spatial means, estimated on about 256x256
+# samples of the image
+_STATS_SIZE = (256, 256)
+_LEVELS = np.arange(256, dtype = np.float32)
+# cube of every uint8 intensity, for the mean of cubes; 255**3 < 2**24 is
+# exact in float32 and cv2.mean sums in double, so the means are exact
+_LEVELS_P3 = _LEVELS * _LEVELS * _LEVELS
+
+@lru_cache(maxsize = 8)
+def _gamma_lut(gamma):
+    look_up_table = (np.power(np.arange(256, dtype = np.float32) / 255.0, 1.0 / gamma) * 255.0).astype(np.uint8).reshape(256, 1)
+    # shared between calls
+    look_up_table.flags.writeable = False
+    return look_up_table
+
+# common gammas are built at import, not on the first call
+for _gamma in (1.8, 2.0, 2.2, 2.4):
+    _gamma_lut(_gamma)
+
+@lru_cache(maxsize = 8)
+def _gamma_lut16(gamma):
+    look_up_table = (np.power(np.arange(65536, dtype = np.float64) / 65535.0, 1.0 / gamma) * 65535.0).astype(np.uint16)
+    # shared between calls
+    look_up_table.flags.writeable = False
+    return look_up_table
+
+def _stats_view(img):
+    # every n-th row and column: a strided view, unlike a resize it neither
+    # reads nor averages the skipped pixels
+    step_y = max(1, img.shape[0] // _STATS_SIZE[1])
+    step_x = max(1, img.shape[1] // _STATS_SIZE[0])
+    return img[::step_y, ::step_x]
+
+def _mean_p3(img):
+    # mean of cubes of a (small) gamma corrected image
+    img = img.astype(np.float64)
+    return cv2.mean(img * img * img)[:3]
+
+def _gains(mean_p3):
     # colar correction
     # Please see reference
-    img_p3 = np.power(img.astype(np.float32), 3)
-    rgb_vec = np.power(np.mean(img_p3, (0, 1)), 1.0/3.0)
-    rgb_norm = np.sqrt(np.mean(np.power(rgb_vec, 2.0)))
-    rgb_vec = rgb_vec / rgb_norm
-    rgb_vec = 1.0 / rgb_vec
-    img = np.multiply(img.astype(np.float32), rgb_vec)
-    return img.astype(np.uint8)
+    # three values only: plain floats are cheaper than numpy calls
+    rgb_vec = [v ** (1.0/3.0) for v in mean_p3]
+    rgb_norm = math.sqrt(sum(v * v for v in rgb_vec) / 3.0)
+    return tuple(rgb_norm / v if v > 0 else 1.0 for v in rgb_vec)
+
+def _check_channels(img):
+    # 3-channel BGR only: the per-channel tables and matrices are 3 wide
+    if img.ndim != 3 or img.shape[2] != 3:
+        raise ValueError('unsupported image shape: %s' % (img.shape,))
+
+def _look_up_table_u8(samples, gamma):
+    gamma_lut = _gamma_lut(gamma)
+    # mean of cubes of the gamma corrected samples: one LUT maps each
+    # level straight to its gamma corrected cube, cv2.mean reduces per channel
+    gains = _gains(cv2.mean(cv2.LUT(samples, _LEVELS_P3[gamma_lut]))[:3])
+    # gamma correction and channel gains composed into one per-channel
+    # look up table, (256, 3)
+    return np.clip(np.rint(gamma_lut * gains), 0, 255).astype(np.uint8)
+
+def _color_constancy_u8(img, gamma):
+    # applied in a single pass
+    return cv2.LUT(img, _look_up_table_u8(_stats_view(img), gamma).reshape(256, 1, 3))
+
+def _color_constancy_u16(img, gamma):
+    gamma_lut = _gamma_lut16(gamma)
+    small = _stats_view(img)
+    gains = _gains(_mean_p3(gamma_lut[small]))
+    # cv2.LUT is 8-bit only: gamma by indexing, then the gains as a
+    # diagonal color transform, which saturates
+    return cv2.transform(gamma_lut[img], np.diag(gains).astype(np.float32))
+
+def _color_constancy_f32(img, gamma):
+    # negative samples are clipped so that the gains stay finite
+    small = np.maximum(_stats_view(img), 0.0)
+    gains = _gains(_mean_p3(cv2.pow(small, 1.0 / gamma)))
+    return cv2.transform(cv2.pow(img, 1.0 / gamma), np.diag(gains).astype(np.float32))
+
+def ColorConstancy(img_file, gamma = 2.2):
+    # a file name, or an image already decoded by cv2.imread; a given image
+    # is not copied and not modified, the corrections write new arrays
+    if isinstance(img_file, np.ndarray):
+        img = img_file
+    else:
+        img = cv2.imread(img_file, cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+        if img is None:
+            raise IOError('cannot read image: %s' % img_file)
+    _check_channels(img)
+    # each depth is corrected in its own representation: uint8 and uint16
+    # saturate; float32 is expected in [0, 1] and is not clipped, and a
+    # negative value has no gamma and comes out NaN at that pixel only
+    if img.dtype == np.uint8:
+        return _color_constancy_u8(img, gamma)
+    if img.dtype == np.uint16:
+        return _color_constancy_u16(img, gamma)
+    if img.dtype == np.float32:
+        return _color_constancy_f32(img, gamma)
+    raise TypeError('unsupported image dtype: %s' % img.dtype)
+
+def ColorConstancyGPU(img, gamma = 2.2):
+    # uint8 image already on the device, as a cupy array. Only the strided
+    # samples cross to the host for the statistics and only the 256x3 table
+    # crosses back; the full size lookup and its result stay on the device
+    if cp is None:
+        raise ImportError('ColorConstancyGPU requires cupy')
+    if not isinstance(img, cp.ndarray):
+        raise TypeError('ColorConstancyGPU takes a cupy array, use ColorConstancy for numpy')
+    _check_channels(img)
+    if img.dtype != np.uint8:
+        raise TypeError('unsupported image dtype: %s' % img.dtype)
+    look_up_table = _look_up_table_u8(cp.asnumpy(_stats_view(img)), gamma)
+    return cp.asarray(look_up_table)[img, cp.arange(3)]
+
+def _adjusted_file(img_file):
+    root, ext = os.path.splitext(img_file)
+    return root + '_adjusted' + ext
+
+def _process_one(img_file):
+    # read -> correct -> write; the path travels with the image, so a file
+    # that cannot be read or written is reported by name
+    adjusted_file = _adjusted_file(img_file)
+    if not cv2.imwrite(adjusted_file, ColorConstancy(img_file)):
+        raise IOError('cannot write image: %s' % adjusted_file)
+
+def _process_files(img_files, threads = 3):
+    # each thread takes one image through all three stages, so the pool
+    # size bounds the images held in memory; OpenCV releases the GIL, so one
+    # image decodes or encodes while another is corrected
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(_process_one, img_files))
+
+def _process_batch(img_files, processes = None):
+    # images are independent of each other: split them across processes,
+    # each running its share through the thread pipeline
+    if not img_files:
+        return
+    processes = min(len(img_files), processes or os.cpu_count() or 1)
+    with ProcessPoolExecutor(processes) as executor:
+        list(executor.map(_process_files, [img_files[i::processes] for i in range(processes)]))
 
 if __name__ == '__main__':
-    cv2.imwrite('ISIC_0012221_adjusted.jpg', ColorConstancy('ISIC_0012221.jpg'))
-    cv2.imwrite('ISIC_0012222_adjusted.jpg', ColorConstancy('ISIC_0012222.jpg'))
+    _process_batch(['ISIC_0012221.jpg', 'ISIC_0012222.jpg'])
@@ -0,0 +1,94 @@
+import os
+import pathlib
+import shutil
+import types
+import numpy as np
+import cv2
+import pytest
+import ColorConstancy as cc
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _read(img_file = 'ISIC_0012221.jpg'):
+    return cv2.imread(os.path.join(_HERE, img_file))
+
+# numpy standing in for cupy: checks the GPU function's own logic only,
+# the device itself is covered by test_gpu_on_device
+_CUPY_SHIM = types.SimpleNamespace(ndarray = np.ndarray, asarray = np.asarray, asnumpy = np.asarray, arange = np.arange)
+
+@pytest.mark.parametrize('img_file', ['ISIC_0012221.jpg', 'ISIC_0012222.jpg'])
+def test_gpu_matches_cpu(monkeypatch, img_file):
+    monkeypatch.setattr(cc, 'cp', _CUPY_SHIM)
+    img = _read(img_file)
+    assert np.array_equal(cc.ColorConstancyGPU(img), cc.ColorConstancy(img))
+
+def test_gpu_on_device():
+    cupy = pytest.importorskip('cupy')
+    try:
+        cupy.cuda.runtime.getDeviceCount()
+    except Exception:
+        pytest.skip('no CUDA device')
+    img = _read()
+    out = cc.ColorConstancyGPU(cupy.asarray(img))
+    assert isinstance(out, cupy.ndarray)
+    assert np.array_equal(cupy.asnumpy(out), cc.ColorConstancy(img))
+
+def test_gpu_rejects_grayscale(monkeypatch):
+    monkeypatch.setattr(cc, 'cp', _CUPY_SHIM)
+    with pytest.raises(ValueError):
+        cc.ColorConstancyGPU(np.zeros((4, 4), dtype = np.uint8))
+
+def test_uint16_tracks_uint8():
+    img = _read()
+    out = cc.ColorConstancy(img.astype(np.uint16) * 257)
+    assert out.dtype == np.uint16 and out.shape == img.shape
+    # 8-bit rounding of the gamma table and the gains, at most a level or two
+    assert np.abs(out / 257.0 - cc.ColorConstancy(img)).max() <= 2.0
+
+def test_float32_tracks_uint8():
+    img = _read()
+    out = cc.ColorConstancy(img.astype(np.float32) / 255.0)
+    assert out.dtype == np.float32 and out.shape == img.shape
+    assert np.abs(np.clip(out, 0.0, 1.0) * 255.0 - cc.ColorConstancy(img)).max() <= 2.0
+
+def test_float32_negative_is_nan_only_there():
+    img = _read().astype(np.float32) / 255.0
+    img[0, 0, 0] = -0.1
+    out = cc.ColorConstancy(img)
+    assert np.isnan(out[0, 0, 0])
+    assert np.isnan(out).sum() == 1
+
+def test_rejects_float64():
+    with pytest.raises(TypeError):
+        cc.ColorConstancy(np.zeros((4, 4, 3), dtype = np.float64))
+
+@pytest.mark.parametrize('shape', [(4, 4), (4, 4, 4)])
+def test_rejects_non_bgr(shape):
+    with pytest.raises(ValueError):
+        cc.ColorConstancy(np.zeros(shape, dtype = np.uint8))
+
+def test_reads_path_objects():
+    img_file = pathlib.Path(_HERE) / 'ISIC_0012221.jpg'
+    assert np.array_equal(cc.ColorConstancy(img_file), cc.ColorConstancy(_read()))
+
+def test_unreadable_file_is_named(tmp_path):
+    img_file = str(tmp_path / 'missing.jpg')
+    with pytest.raises(IOError, match = 'missing.jpg'):
+        cc.ColorConstancy(img_file)
+    with pytest.raises(IOError, match = 'missing.jpg'):
+        cc._process_files([img_file])
+
+def test_process_files_writes_adjusted(tmp_path):
+    img_file = tmp_path / 'ISIC_0012221.jpg'
+    shutil.copy(os.path.join(_HERE, 'ISIC_0012221.jpg'), str(img_file))
+    cc._process_files([str(img_file)])
+    assert cv2.imread(str(tmp_path / 'ISIC_0012221_adjusted.jpg')).shape == _read().shape
+
+def test_process_batch_writes_every_file(tmp_path):
+    img_files = []
+    for img_file in ['ISIC_0012221.jpg', 'ISIC_0012222.jpg']:
+        shutil.copy(os.path.join(_HERE, img_file), str(tmp_path / img_file))
+        img_files.append(str(tmp_path / img_file))
+    cc._process_batch(img_files, processes = 2)
+    for img_file in img_files:
+        assert os.path.exists(cc._adjusted_file(img_file))